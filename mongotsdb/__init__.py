@@ -1,8 +1,14 @@
 from pymongo import Connection
 from datetime import datetime
 from itertools import chain
+from time import time
 
 from ranges import *
+from functions import get_function
+from expression import parse, ExpressionPlanner
+from retention import (RetentionPolicy, Compactor, CompactionThread,
+    rollup_collection_name, RETENTION_COLLECTION)
+from subscription import Subscription
 
 class TSDB(object):
     def __init__(self, database_name):
@@ -30,19 +36,35 @@ class TSDB(object):
         #     stop = stop + (step - (stop % step))
 
         request_call = request.pop("request")
-        aggregation_function, metric_name = self._parse_request(request_call)
         tags = request.pop("tags", {})
 
+        # Expressions are computed from their aggregations on metrics
+        expression = parse(request_call)
+        if not expression.is_aggregation():
+            planner = ExpressionPlanner(self, start, stop, step, tags)
+            return planner.evaluate(expression)
+
+        aggregation_function = expression.function
+        metric_name = expression.arguments[0].name
+        function = get_function(aggregation_function)
+
+        # Old data may only be in rollups
+        segments = self._segments(metric_name, start, stop, step)
+        if segments != [(None, start, stop)]:
+            result = self._request_segments(segments, step,
+                aggregation_function, metric_name, tags)
+            return self._finalize(result, function)
+
         collection = self.db[metric_name]
         cache_collection = self.db['%s.cache' % metric_name]
 
-        # If avg is function or tags wildcard value is used, cannot use cache
-        if aggregation_function == 'avg' or '*' in tags.values():
+        # If tags wildcard value is used, cannot use cache
+        if '*' in tags.values():
             worker = MultiRangeWorker(start, stop, step, aggregation_function,
                 tags, collection)
             result = worker.compute()
             # self.save_result_in_cache(result, metric_name, step, aggregation_function)
-            return result
+            return self._finalize(result, function)
         else:
             range_set = RangeSet(start, stop, step, aggregation_function, tags,
                 collection)
@@ -56,7 +78,148 @@ class TSDB(object):
             self.save_result_in_cache(results, metric_name, step,
                 aggregation_function)
 
-            return results
+            return self._finalize(results, function)
+
+    def request_many(self, requests):
+        """Make several requests, sharing scans between them.
+
+        Requests on the same metric, range, step and tags names are computed
+        with a single aggregation, whatever their function or tags values
+        are, by retention tier. Cache is not used. Results are returned in
+        requests order.
+        """
+        batches = {}
+
+        for index, request in enumerate(requests):
+            aggregation_function, metric_name = self._parse_request(
+                request['request'])
+            tags = request.get('tags', {})
+
+            key = (metric_name, request['start'], request['stop'],
+                request['step'], tuple(sorted(tags)))
+            batches.setdefault(key, []).append((index, aggregation_function,
+                tags))
+
+        results = [None] * len(requests)
+
+        for (metric_name, start, stop, step, _), batch in batches.items():
+            batch_results = [[] for _ in batch]
+
+            for tier_step, segment_start, segment_stop in self._segments(
+                    metric_name, start, stop, step):
+                worker = BatchWorker(segment_start, segment_stop, step,
+                    [(function, tags) for (_, function, tags) in batch],
+                    self._tier_collection(metric_name, tier_step),
+                    rollup=tier_step is not None)
+
+                for batch_result, result in zip(batch_results,
+                        worker.compute()):
+                    batch_result.extend(result)
+
+            for (index, function, _), result in zip(batch, batch_results):
+                function = get_function(function)
+                results[index] = self._finalize(self._merge_results(result,
+                    function), function)
+
+        return results
+
+    def subscribe(self, request, margin=5):
+        """Return a Subscription computing request incrementally.
+
+        Call its poll method with the new stop date to get what changed since
+        the previous poll, the window width stays the same. Points inserted
+        up to margin seconds before a poll are checked again by the next one.
+        """
+        return Subscription(self, request, margin)
+
+    def set_retention(self, metric_name, rules):
+        """Set retention rules of a metric.
+
+        Rules are a list of (step, duration) tuples, durations are in seconds.
+        First rule is for raw metrics and has a None step, a None duration
+        keeps data forever. For example, raw metrics for 7 days, 1 minute
+        rollups for 90 days and 1 hour rollups forever:
+
+            [(None, 7*86400), (60, 90*86400), (3600, None)]
+        """
+        policy = RetentionPolicy.from_rules(rules)
+
+        # Keep watermarks of existing rollups
+        old_policy = self.get_retention(metric_name)
+        if old_policy is not None:
+            watermarks = dict((tier['step'], tier['watermark']) for tier in
+                old_policy.tiers)
+            for tier in policy.tiers:
+                tier['watermark'] = watermarks.get(tier['step'])
+
+        self._save_retention(metric_name, policy)
+
+    def get_retention(self, metric_name):
+        document = self.db[RETENTION_COLLECTION].find_one({'_id': metric_name})
+
+        if document is None:
+            return None
+
+        return RetentionPolicy(document['tiers'])
+
+    def compact(self, now=None, lag=60, chunk_steps=100):
+        """Roll up and delete expired data of metrics with retention rules.
+
+        A step is rolled up lag seconds after its end, so points inserted
+        with some delay are still in rollups.
+        """
+        if now is None:
+            now = int(time())
+
+        for document in self.db[RETENTION_COLLECTION].find():
+            policy = RetentionPolicy(document['tiers'])
+            Compactor(self.db, document['_id'], policy, lag,
+                chunk_steps).compact(now)
+
+    def start_compaction(self, interval=60, lag=60):
+        """Start a background thread compacting metrics every interval."""
+        thread = CompactionThread(self, interval, lag)
+        thread.start()
+        return thread
+
+    def _save_retention(self, metric_name, policy):
+        self.db[RETENTION_COLLECTION].save({'_id': metric_name,
+            'tiers': policy.tiers})
+
+    def _segments(self, metric_name, start, stop, step):
+        policy = self.get_retention(metric_name)
+
+        if policy is None:
+            return [(None, start, stop)]
+
+        return policy.segments(start, stop, step, int(time()))
+
+    def _tier_collection(self, metric_name, tier_step):
+        if tier_step is None:
+            return self.db[metric_name]
+
+        return self.db[rollup_collection_name(metric_name, tier_step)]
+
+    def _request_segments(self, segments, step, aggregation_function,
+            metric_name, tags):
+        results = []
+        for tier_step, start, stop in segments:
+            worker = MultiRangeWorker(start, stop, step, aggregation_function,
+                tags, self._tier_collection(metric_name, tier_step),
+                rollup=tier_step is not None)
+            results.extend(worker.compute())
+
+        return self._merge_results(results, get_function(aggregation_function))
+
+    def _merge_results(self, results, function):
+        # Steps split between two segments are merged
+        states = {}
+        for r in results:
+            states.setdefault(result_key(r), (r['_id'], []))[1].append(
+                r['value'])
+
+        return [{'_id': id_doc, 'value': function.merge(values)}
+            for (id_doc, values) in states.values()]
 
     def _load_from_cache(self, start, stop, step, aggregation_function,
             range_set, cache_collection):
@@ -69,15 +232,20 @@ class TSDB(object):
                 steps.append(int(new_step))
 
 
-        cache_request = {'function': aggregation_function,
+        function = get_function(aggregation_function)
+
+        cache_request = {'function': function.cache_name,
             'step': {'$in': steps}, 'date': {'$gte': start, '$lt': stop}}
 
         caches = cache_collection.find(cache_request).sort('step', -1).sort('date')
         for cache in caches:
             range_set.add_sub_range(SubRange(cache['date'],
-                cache['date'] + (cache['step'] - 1), cache['value']))
+                cache['date'] + (cache['step'] - 1),
+                function.load(cache['value'])))
 
     def save_result_in_cache(self, result, metric_name, step, function):
+        function = get_function(function)
+
         # Save results into cache
         cache_collection = self.db['%s.cache' % metric_name]
         # Ensure TTL
@@ -88,11 +256,21 @@ class TSDB(object):
             cache_document = {}
             date = r.get('_id')['date']
             cache_document['date'] = date
-            cache_document['value'] = r['value']
+            cache_document['value'] = function.dump(r['value'])
             cache_document['step'] = step
-            cache_document['function'] = function
+            cache_document['function'] = function.cache_name
             cache_document['cdate'] = datetime.now()
             cache_collection.insert(cache_document)
 
+    def _finalize(self, result, function):
+        # Compute final values from partial states
+        return function.finalize_results(result)
+
     def _parse_request(self, request_call):
-        return request_call.replace('(', ' ').replace(')', '').split()
+        expression = parse(request_call)
+
+        if not expression.is_aggregation():
+            raise ValueError('Request %s is not an aggregation of a metric' %
+                request_call)
+
+        return expression.function, expression.arguments[0].name
@@ -0,0 +1,426 @@
+import re
+from operator import add, sub, mul
+
+from functions import get_function
+
+
+# Nodes
+
+class Node(object):
+
+    def __eq__(self, node):
+        return (self.__class__ == node.__class__ and
+            self.__dict__ == node.__dict__)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.__dict__)
+
+    def is_aggregation(self):
+        return False
+
+
+class Number(Node):
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class Metric(Node):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        if NAME_REGEX.match(self.name):
+            return self.name
+
+        return '`%s`' % self.name
+
+
+class Call(Node):
+
+    def __init__(self, function, arguments):
+        self.function = function
+        self.arguments = arguments
+
+    def __str__(self):
+        return '%s(%s)' % (self.function,
+            ', '.join(str(argument) for argument in self.arguments))
+
+    def is_aggregation(self):
+        """Call of an aggregation function on a metric, computed by mongo."""
+        return (get_function(self.function) is not None and
+            len(self.arguments) == 1 and isinstance(self.arguments[0], Metric))
+
+
+class BinaryOperation(Node):
+
+    def __init__(self, operator, left, right):
+        self.operator = operator
+        self.left = left
+        self.right = right
+
+    def __str__(self):
+        return '(%s %s %s)' % (self.left, self.operator, self.right)
+
+
+class Negation(Node):
+
+    def __init__(self, operand):
+        self.operand = operand
+
+    def __str__(self):
+        return '-%s' % self.operand
+
+
+# Parser
+
+NAME_REGEX = re.compile(r'^[A-Za-z_][\w.]*$')
+
+TOKEN_REGEX = re.compile(r'\s*(?:(\d+\.?\d*(?:[eE][-+]?\d+)?)|([A-Za-z_][\w.]*)'
+    r'|`([^`]+)`|(.))')
+
+# Single aggregation, metric name can contain any character except
+# parenthesis and backquotes, like with the first request format
+AGGREGATION_REGEX = re.compile(r'^\s*([A-Za-z_]\w*)\(\s*([^()`\s]+)\s*\)\s*$')
+
+
+def tokenize(text):
+    tokens = []
+
+    for number, name, quoted, symbol in TOKEN_REGEX.findall(text.strip()):
+        if number:
+            tokens.append(('number', float(number) if set('.eE') & set(number)
+                else int(number)))
+        elif name:
+            tokens.append(('name', name))
+        elif quoted:
+            tokens.append(('metric', quoted))
+        elif symbol in '+-*/(),':
+            tokens.append(('symbol', symbol))
+        else:
+            raise ValueError('Unexpected character %r in %r' % (symbol, text))
+
+    return tokens
+
+
+class Parser(object):
+    """Recursive descent parser of requests expressions.
+
+    Grammar:
+        expression := term (('+' | '-') term)*
+        term := factor (('*' | '/') factor)*
+        factor := number | '-' factor | '(' expression ')'
+            | name '(' expression (',' expression)* ')' | name | quoted name
+
+    Metrics names with other characters than letters, digits, '_' and '.'
+    must be quoted with backquotes, like `api/requests`.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.position = 0
+
+    def parse(self):
+        node = self.expression()
+
+        if self.position != len(self.tokens):
+            self._error()
+
+        return node
+
+    def expression(self):
+        node = self.term()
+
+        while self._peek() in (('symbol', '+'), ('symbol', '-')):
+            operator = self._next()[1]
+            node = BinaryOperation(operator, node, self.term())
+
+        return node
+
+    def term(self):
+        node = self.factor()
+
+        while self._peek() in (('symbol', '*'), ('symbol', '/')):
+            operator = self._next()[1]
+            node = BinaryOperation(operator, node, self.factor())
+
+        return node
+
+    def factor(self):
+        token_type, value = self._next()
+
+        if token_type == 'number':
+            return Number(value)
+
+        elif token_type == 'metric':
+            return Metric(value)
+
+        elif (token_type, value) == ('symbol', '-'):
+            return Negation(self.factor())
+
+        elif (token_type, value) == ('symbol', '('):
+            node = self.expression()
+            self._expect(')')
+            return node
+
+        elif token_type == 'name':
+            if self._peek() != ('symbol', '('):
+                return Metric(value)
+
+            self._next()
+            arguments = [self.expression()]
+            while self._peek() == ('symbol', ','):
+                self._next()
+                arguments.append(self.expression())
+            self._expect(')')
+
+            return Call(value, arguments)
+
+        self._error()
+
+    # Util function
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def _next(self):
+        token = self._peek()
+        self.position += 1
+        return token
+
+    def _expect(self, symbol):
+        if self._next() != ('symbol', symbol):
+            self._error()
+
+    def _error(self):
+        raise ValueError('Invalid request %r' % self.text)
+
+
+def parse(text):
+    match = AGGREGATION_REGEX.match(text)
+
+    if match:
+        return Call(match.group(1), [Metric(match.group(2))])
+
+    return Parser(text).parse()
+
+
+# Planner
+
+def divide(left, right):
+    if not right:
+        return None
+    return float(left) / right
+
+
+def avg(values):
+    return float(sum(values)) / len(values)
+
+
+class ExpressionPlanner(object):
+    """Evaluate an expression over aligned steps.
+
+    Aggregations on metrics are computed by mongo, all at once with
+    TSDB.request_many so aggregations on the same metric share a single scan.
+    Arithmetic and functions of functions are then computed client-side on
+    series aligned by date and tags. Each subexpression is computed once.
+
+    Series are dicts mapping (date, tags items) to values.
+    """
+
+    operators = {
+        '+': add,
+        '-': sub,
+        '*': mul,
+        '/': divide
+    }
+
+    # Functions applied point by point
+    series_functions = {
+        'abs': abs
+    }
+
+    # Functions reducing all tags of a step into a single value
+    reduce_functions = {
+        'sum': sum,
+        'min': min,
+        'max': max,
+        'avg': avg,
+        'count': len
+    }
+
+    def __init__(self, tsdb, start, stop, step, tags=None):
+        self.tsdb = tsdb
+        self.start = start
+        self.stop = stop
+        self.step = step
+        self.tags = tags or {}
+
+        self.cache = {}
+
+    def evaluate(self, node):
+        aggregations = []
+        self._collect_aggregations(node, aggregations)
+
+        if not aggregations:
+            raise ValueError('Request %s does not use any metric' % node)
+
+        requests = [{'request': str(aggregation), 'start': self.start,
+            'stop': self.stop, 'step': self.step, 'tags': self.tags}
+            for aggregation in aggregations]
+        results = self.tsdb.request_many(requests)
+
+        for aggregation, result in zip(aggregations, results):
+            self.cache[str(aggregation)] = self._to_series(result)
+
+        return self._to_result(self._evaluate(node))
+
+    def _collect_aggregations(self, node, aggregations):
+        if isinstance(node, Call) and node.is_aggregation():
+            if node not in aggregations:
+                aggregations.append(node)
+
+        elif isinstance(node, Call):
+            if get_function(node.function) is None and any(
+                    isinstance(argument, Metric) for argument in node.arguments):
+                raise ValueError('Unknown aggregation function %s' %
+                    node.function)
+
+            for argument in node.arguments:
+                self._collect_aggregations(argument, aggregations)
+
+        elif isinstance(node, BinaryOperation):
+            self._collect_aggregations(node.left, aggregations)
+            self._collect_aggregations(node.right, aggregations)
+
+        elif isinstance(node, Negation):
+            self._collect_aggregations(node.operand, aggregations)
+
+        elif isinstance(node, Metric):
+            raise ValueError('Metric %s must be aggregated' % node)
+
+    def _evaluate(self, node):
+        key = str(node)
+
+        if key not in self.cache:
+            self.cache[key] = self._compute(node)
+
+        return self.cache[key]
+
+    def _compute(self, node):
+        if isinstance(node, Number):
+            return node.value
+
+        elif isinstance(node, Negation):
+            return self._apply(lambda value: -value, self._evaluate(node.operand))
+
+        elif isinstance(node, BinaryOperation):
+            return self._combine(self.operators[node.operator],
+                self._evaluate(node.left), self._evaluate(node.right))
+
+        elif len(node.arguments) != 1:
+            raise ValueError('Function %s takes exactly one argument' %
+                node.function)
+
+        elif node.function in self.series_functions:
+            return self._apply(self.series_functions[node.function],
+                self._evaluate(node.arguments[0]))
+
+        elif node.function in self.reduce_functions:
+            return self._reduce(self.reduce_functions[node.function],
+                self._evaluate(node.arguments[0]))
+
+        raise ValueError('Unknown function %s' % node.function)
+
+    def _apply(self, function, operand):
+        # Scalars and steps without value, like divisions by zero, have no
+        # value
+        if not isinstance(operand, dict):
+            return None if operand is None else function(operand)
+
+        return dict((key, None if value is None else function(value))
+            for key, value in operand.items())
+
+    def _combine(self, operator, left, right):
+        if not isinstance(left, dict) and not isinstance(right, dict):
+            if left is None or right is None:
+                return None
+            return operator(left, right)
+
+        if not isinstance(left, dict):
+            return self._apply(lambda value: self._combine(operator, left,
+                value), right)
+
+        if not isinstance(right, dict):
+            return self._apply(lambda value: self._combine(operator, value,
+                right), left)
+
+        # Series without tags are broadcasted on each tags of the same date
+        if self._untagged(right):
+            keys, lookup = left.keys(), lambda key: (key[0], ())
+        elif self._untagged(left):
+            keys, lookup = right.keys(), lambda key: (key[0], ())
+        else:
+            keys, lookup = left.keys(), lambda key: key
+
+        series = {}
+
+        for key in keys:
+            left_key = key if key in left else lookup(key)
+            right_key = key if key in right else lookup(key)
+
+            # Steps are kept only if present on both sides
+            if left_key not in left or right_key not in right:
+                continue
+
+            left_value, right_value = left[left_key], right[right_key]
+
+            if left_value is None or right_value is None:
+                series[key] = None
+            else:
+                series[key] = operator(left_value, right_value)
+
+        return series
+
+    def _reduce(self, function, operand):
+        if not isinstance(operand, dict):
+            raise ValueError('Cannot reduce a scalar')
+
+        values = {}
+        for (date, tags), value in operand.items():
+            if value is not None:
+                values.setdefault(date, []).append(value)
+
+        return dict(((date, ()), function(date_values))
+            for date, date_values in values.items())
+
+    def _untagged(self, series):
+        return all(not tags for (date, tags) in series)
+
+    def _to_series(self, result):
+        return dict(((r['_id']['date'],
+            tuple(sorted(r['_id'].get('tags', {}).items()))), r['value'])
+            for r in result)
+
+    def _to_result(self, series):
+        if not isinstance(series, dict):
+            raise ValueError('Request result is a scalar')
+
+        result = []
+
+        for (date, tags) in sorted(series):
+            id_doc = {'date': date}
+
+            if tags:
+                id_doc['tags'] = dict(tags)
+
+            result.append({'_id': id_doc, 'value': series[(date, tags)]})
+
+        return result
@@ -0,0 +1,350 @@
+from math import sqrt
+
+from sketch import DDSketch
+
+
+class AggregationFunction(object):
+    """Aggregation function computed in two times.
+
+    The aggregation pipeline computes a partial state for each step, partial
+    states of several subranges (cached or freshly computed) can be merged and
+    the final value is computed from the merged state.
+    """
+
+    name = None
+
+    # Function need points sorted by date before grouping
+    ordered = False
+
+    # Function state cannot be computed by mongo, it is built client-side
+    # from the values of the points, read with a cursor
+    scanned = False
+
+    # Function final value depends on the previous step state
+    previous_step = False
+
+    @property
+    def cache_name(self):
+        return self.name
+
+    def accumulators(self):
+        """Return the $group accumulators computing the partial state."""
+        raise NotImplementedError
+
+    def state(self, document):
+        """Extract the partial state from a $group result document."""
+        raise NotImplementedError
+
+    def add(self, state, value):
+        """Return state with a point value added, for scanned functions.
+
+        State is None for the first point of a group.
+        """
+        raise NotImplementedError
+
+    def rollup_accumulators(self):
+        """Return the $group accumulators merging states saved in rollups.
+
+        Rollups documents contain the dumped state of each function under
+        its cache name.
+        """
+        raise NotImplementedError
+
+    def rollup_state(self, document):
+        return self.state(document)
+
+    def merge(self, states):
+        raise NotImplementedError
+
+    def finalize(self, state):
+        return state
+
+    def finalize_results(self, results):
+        """Compute final values of results, a list of steps states."""
+        return [{'_id': r['_id'], 'value': self.finalize(r['value'])}
+            for r in results]
+
+    def dump(self, state):
+        """Convert a state into a value which can be saved in cache."""
+        return state
+
+    def load(self, value):
+        return value
+
+    def __str__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.name)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class Operator(AggregationFunction):
+    """Function which state is directly computed by a mongo operator."""
+
+    def __init__(self, name, operator, merge_function, argument='$value',
+            merge_operator=None):
+        self.name = name
+        self.operator = operator
+        self.merge_function = merge_function
+        self.argument = argument
+        self.merge_operator = merge_operator or operator
+
+    def accumulators(self):
+        return {'value': {self.operator: self.argument}}
+
+    def rollup_accumulators(self):
+        return {'value': {self.merge_operator: '$%s' % self.cache_name}}
+
+    def state(self, document):
+        return document['value']
+
+    def merge(self, states):
+        return self.merge_function(states)
+
+
+class Avg(AggregationFunction):
+
+    name = 'avg'
+
+    def accumulators(self):
+        return {'sum': {'$sum': '$value'}, 'count': {'$sum': 1}}
+
+    def rollup_accumulators(self):
+        return {'sum': {'$sum': '$avg.sum'}, 'count': {'$sum': '$avg.count'}}
+
+    def state(self, document):
+        return {'sum': document['sum'], 'count': document['count']}
+
+    def merge(self, states):
+        return {'sum': sum(s['sum'] for s in states),
+            'count': sum(s['count'] for s in states)}
+
+    def finalize(self, state):
+        if not state['count']:
+            return None
+
+        return float(state['sum']) / state['count']
+
+
+class StdDev(AggregationFunction):
+    """Population standard deviation.
+
+    Sums of squares computed by mongo lose all precision on values with a
+    large offset, like counters, so the state is the count, mean and sum of
+    squared differences from the mean (M2) of the points, built client-side
+    with Welford algorithm and merged with the parallel variance formula.
+    """
+
+    name = 'stddev'
+    scanned = True
+
+    def rollup_accumulators(self):
+        return {'states': {'$push': '$stddev'}}
+
+    def rollup_state(self, document):
+        return self.merge(document['states'])
+
+    def add(self, state, value):
+        if state is None:
+            return {'count': 1, 'mean': float(value), 'm2': 0.0}
+
+        count = state['count'] + 1
+        delta = value - state['mean']
+        mean = state['mean'] + delta / count
+
+        return {'count': count, 'mean': mean,
+            'm2': state['m2'] + delta * (value - mean)}
+
+    def merge(self, states):
+        merged = {'count': 0, 'mean': 0.0, 'm2': 0.0}
+
+        for state in states:
+            count = merged['count'] + state['count']
+            if not count:
+                continue
+
+            delta = state['mean'] - merged['mean']
+            merged = {'count': count,
+                'mean': merged['mean'] + delta * state['count'] / count,
+                'm2': merged['m2'] + state['m2'] +
+                    delta ** 2 * merged['count'] * state['count'] / count}
+
+        return merged
+
+    def finalize(self, state):
+        if not state['count']:
+            return None
+
+        return sqrt(state['m2'] / state['count'])
+
+
+class First(AggregationFunction):
+
+    name = 'first'
+    ordered = True
+    operator = '$first'
+
+    def accumulators(self):
+        return {'date': {self.operator: '$timestamp'},
+            'value': {self.operator: '$value'}}
+
+    def rollup_accumulators(self):
+        # Rollups of several tags share the same date, states are merged by
+        # their points dates
+        return {'states': {'$push': '$%s' % self.cache_name}}
+
+    def state(self, document):
+        return {'date': document['date'], 'value': document['value']}
+
+    def rollup_state(self, document):
+        return self.merge(document['states'])
+
+    def merge(self, states):
+        return min(states, key=lambda s: s['date'])
+
+    def finalize(self, state):
+        return state['value']
+
+
+class Last(First):
+
+    name = 'last'
+    operator = '$last'
+
+    def merge(self, states):
+        return max(states, key=lambda s: s['date'])
+
+
+class Rate(AggregationFunction):
+    """Per-second rate of a counter.
+
+    Rate of a step is computed between the last point of the previous step
+    with the same tags and the last point of the step, so steps with a single
+    point have a rate and no increase is lost between steps. First step of a
+    request has no previous step, its rate is computed between its own first
+    and last points. Counter resets are not detected.
+    """
+
+    name = 'rate'
+    ordered = True
+    previous_step = True
+
+    def accumulators(self):
+        return {'first_date': {'$first': '$timestamp'},
+            'first_value': {'$first': '$value'},
+            'last_date': {'$last': '$timestamp'},
+            'last_value': {'$last': '$value'}}
+
+    def rollup_accumulators(self):
+        return {'states': {'$push': '$rate'}}
+
+    def state(self, document):
+        return {
+            'first': {'date': document['first_date'],
+                'value': document['first_value']},
+            'last': {'date': document['last_date'],
+                'value': document['last_value']}}
+
+    def rollup_state(self, document):
+        return self.merge(document['states'])
+
+    def merge(self, states):
+        return {'first': min((s['first'] for s in states),
+                key=lambda p: p['date']),
+            'last': max((s['last'] for s in states), key=lambda p: p['date'])}
+
+    def finalize(self, state):
+        return self._rate(state['first'], state['last'])
+
+    def finalize_results(self, results):
+        previous = {}
+        finalized = []
+
+        for r in sorted(results, key=lambda r: r['_id']['date']):
+            tags = tuple(sorted((r['_id'].get('tags') or {}).items()))
+            first = previous.get(tags, r['value']['first'])
+            previous[tags] = r['value']['last']
+
+            finalized.append({'_id': r['_id'],
+                'value': self._rate(first, r['value']['last'])})
+
+        return finalized
+
+    def _rate(self, first, last):
+        duration = last['date'] - first['date']
+
+        if not duration:
+            return None
+
+        return float(last['value'] - first['value']) / duration
+
+
+class Percentile(AggregationFunction):
+    """Approximate percentile computed with a DDSketch.
+
+    Mongo aggregation framework cannot compute logarithms, so the values of
+    the points are read with a cursor and the sketch is built client-side.
+    The sketch is what is saved in cache and rollups, every percentile share
+    the same state.
+    """
+
+    cache_name = 'sketch'
+    scanned = True
+
+    def __init__(self, name, quantile, relative_accuracy=0.01):
+        self.name = name
+        self.quantile = quantile
+        self.relative_accuracy = relative_accuracy
+
+    def rollup_accumulators(self):
+        return {'sketches': {'$push': '$sketch'}}
+
+    def add(self, state, value):
+        if state is None:
+            state = DDSketch(self.relative_accuracy)
+
+        state.add(value)
+        return state
+
+    def rollup_state(self, document):
+        return self.merge([self.load(value) for value in document['sketches']])
+
+    def merge(self, states):
+        sketch = DDSketch(self.relative_accuracy)
+        for state in states:
+            sketch.merge(state)
+        return sketch
+
+    def finalize(self, state):
+        return state.quantile(self.quantile)
+
+    def dump(self, state):
+        return state.to_dict()
+
+    def load(self, value):
+        return DDSketch.from_dict(value)
+
+
+FUNCTIONS = dict((function.name, function) for function in [
+    Operator('sum', '$sum', sum),
+    Operator('min', '$min', min),
+    Operator('max', '$max', max),
+    Operator('count', '$sum', sum, argument=1),
+    Avg(),
+    StdDev(),
+    First(),
+    Last(),
+    Rate(),
+    Percentile('p50', 0.5),
+    Percentile('p95', 0.95),
+    Percentile('p99', 0.99),
+])
+
+
+# One function by state, states saved in rollups
+ROLLUP_FUNCTIONS = dict((function.cache_name, function) for function in
+    FUNCTIONS.values()).values()
+
+
+def get_function(name):
+    return FUNCTIONS.get(name)
@@ -1,32 +1,125 @@
+from functions import get_function, ROLLUP_FUNCTIONS
 
 class PipelineGenerator(object):
 
-    def dispatch_function(self, start, stop, step=None, function=None, tags=None):
-        pipeline = [self._request_match(start, stop, tags),
-            self._aggregate_date(step, tags)]
+    def dispatch_function(self, start, stop, step=None, function=None, tags=None,
+            rollup=False):
+        function = get_function(function)
 
-        function_call = getattr(self, function, None)
+        if function is None:
+            return None
+
+        pipeline = [self._request_match(start, stop, tags)]
+
+        # Rollups states of ordered functions are merged client-side
+        ordered = function.ordered and not rollup
+        if ordered:
+            pipeline.append(self._sort_date())
+
+        if rollup:
+            accumulators = function.rollup_accumulators()
+            fields = [function.cache_name]
+        else:
+            accumulators = function.accumulators()
+            fields = ['value']
 
-        if function_call is None:
+        pipeline.append(self._aggregate_date(step, tags,
+            keep_timestamp=ordered, fields=fields))
+
+        pipeline.append(self._regroup(accumulators, tags,
+            group_by_date=step is not None))
+
+        return pipeline
+
+    def dispatch_functions(self, start, stop, step, functions, tags,
+            rollup=False):
+        """Generate a single pipeline computing several functions states.
+
+        Each function accumulators are prefixed by its cache name, functions
+        sharing the same state (like percentiles) are only computed once.
+        Scanned functions are only computed by aggregations on rollups.
+        """
+        functions = [get_function(function) for function in functions]
+
+        if None in functions:
             return None
 
-        pipeline.append(self._regroup(function_call(), tags, group_by_date=step is not None))
+        ordered = not rollup and any(function.ordered
+            for function in functions)
+
+        pipeline = [self._request_match(start, stop, tags)]
+
+        if ordered:
+            pipeline.append(self._sort_date())
+
+        accumulators = {}
+        for function in functions:
+            if rollup:
+                function_accumulators = function.rollup_accumulators()
+            else:
+                function_accumulators = function.accumulators()
+
+            for field, accumulator in function_accumulators.items():
+                accumulators[self.batch_field(function, field)] = accumulator
+
+        if rollup:
+            fields = [function.cache_name for function in functions]
+        else:
+            fields = ['value']
+
+        pipeline.append(self._aggregate_date(step, tags,
+            keep_timestamp=ordered, fields=fields))
+
+        pipeline.append(self._regroup(accumulators, tags,
+            group_by_date=step is not None))
 
         return pipeline
 
-    # Operator
+    def dispatch_rollup(self, start, stop, step, rollup=False,
+            functions=ROLLUP_FUNCTIONS):
+        """Generate the pipeline computing rollups of raw metrics or rollups.
+
+        Groups are made by step and by whole tags documents, each group
+        contains the state of every given rollup function. Scanned functions
+        are only computed by aggregations on rollups.
+        """
+        pipeline = [self._request_match(start, stop, {})]
+
+        if not rollup:
+            pipeline.append(self._sort_date())
+
+        accumulators = {}
+        for function in functions:
+            if rollup:
+                function_accumulators = function.rollup_accumulators()
+            else:
+                function_accumulators = function.accumulators()
 
-    def sum(self):
-        return '$sum'
+            for field, accumulator in function_accumulators.items():
+                accumulators[self.batch_field(function, field)] = accumulator
 
-    def min(self):
-        return '$min'
+        if rollup:
+            fields = [function.cache_name for function in functions]
+        else:
+            fields = ['value']
 
-    def max(self):
-        return '$max'
+        projection = self._aggregate_date(step, {}, keep_timestamp=not rollup,
+            fields=fields)
+        projection['$project']['tags'] = 1
+        pipeline.append(projection)
 
-    def avg(self):
-        return '$avg'
+        group = self._regroup(accumulators, {})
+        group['$group']['_id']['tags'] = '$tags'
+        pipeline.append(group)
+
+        return pipeline
+
+    def dispatch_scan(self, start, stop, tags):
+        """Generate the query of the points read by scanned functions."""
+        return self._request_match(start, stop, tags)['$match']
+
+    def batch_field(self, function, field):
+        return '%s__%s' % (function.cache_name, field)
 
     # Util function
 
@@ -39,22 +132,32 @@ class PipelineGenerator(object):
 
         return base
 
-    def _aggregate_date(self, step, tags):
-        base = {'$project': {'value': 1}}
+    def _sort_date(self):
+        return {'$sort': {'date': 1}}
+
+    def _aggregate_date(self, step, tags, keep_timestamp=False,
+            fields=('value',)):
+        base = {'$project': dict((field, 1) for field in fields)}
 
         if step is not None:
             base['$project']['date'] = {'$subtract': ['$date', {'$mod': ['$date', step]}]}
 
+        # Keep original date, needed by functions like first or last
+        if keep_timestamp:
+            base['$project']['timestamp'] = '$date'
+
         for tag in tags:
             base['$project']['tags.%s' % tag] = 1
 
         return base
 
-    def _regroup(self, function_name, tags, group_by_date=True):
-        base = {'$group': {'value': {function_name: '$value'}, '_id': None}}
+    def _regroup(self, accumulators, tags, group_by_date=True):
+        base = {'$group': dict(accumulators, _id=None)}
 
         if group_by_date:
             base['$group']['_id'] = {'date': '$date'}
+        elif tags:
+            base['$group']['_id'] = {}
 
         for tag in tags:
             base['$group']['_id'].setdefault('tags', {})['%s' % tag] = '$tags.%s' % tag
@@ -1,4 +1,5 @@
 from pipeline import PipelineGenerator
+from functions import get_function
 
 class RangeSet(object):
 
@@ -151,17 +152,65 @@ class SubRange(object):
                 SubRange(subrange.stop + 1, self.stop)]
 
 
+def result_key(result):
+    """Hashable key identifying the step and tags of a result."""
+    return (result['_id'].get('date'),
+        tuple(sorted((result['_id'].get('tags') or {}).items())))
+
+
+def partition_functions(functions):
+    """Split functions computed by aggregations from scanned ones."""
+    return [group for group in
+        ([f for f in functions if not f.scanned],
+         [f for f in functions if f.scanned]) if group]
+
+
+def scan_states(collection, query, step, tags, functions, whole_tags=False):
+    """Compute states of scanned functions from the points matching query.
+
+    Points are read with a cursor, so the size of the results is not limited
+    like an aggregation reply, but every point is sent to the client. Points
+    are grouped like aggregations do, by step (unless step is None) and tags
+    names, or whole tags documents, each group has a state by cache name.
+    """
+    functions = dict((function.cache_name, function)
+        for function in functions).values()
+    groups = {}
+
+    for point in collection.find(query, fields=['date', 'value', 'tags']):
+        id_doc = {}
+
+        if step is not None:
+            id_doc['date'] = point['date'] - (point['date'] % step)
+
+        point_tags = point.get('tags') or {}
+        if not whole_tags:
+            point_tags = dict((tag, point_tags[tag]) for tag in tags
+                if tag in point_tags)
+        if point_tags:
+            id_doc['tags'] = point_tags
+
+        group = groups.setdefault(result_key({'_id': id_doc}),
+            {'_id': id_doc})
+        for function in functions:
+            group[function.cache_name] = function.add(
+                group.get(function.cache_name), point['value'])
+
+    return groups.values()
+
+
 # Workers
 
 class MultiRangeWorker(object):
     def __init__(self, start, stop, step, aggregation_function=None, tags=None,
-            collection=None):
+            collection=None, rollup=False):
         self.start = start
         self.stop = stop
         self.step = step
         self.aggregation_function = aggregation_function
         self.tags = tags
         self.collection = collection
+        self.rollup = rollup
 
     def __eq__(self, subrange):
         return self.__dict__ == subrange.__dict__
@@ -174,17 +223,27 @@ class MultiRangeWorker(object):
 
     def compute(self):
         generator = PipelineGenerator()
+        function = get_function(self.aggregation_function)
+
+        # Rollups contain states of scanned functions
+        if function.scanned and not self.rollup:
+            query = generator.dispatch_scan(self.start, self.stop, self.tags)
+            return [{'_id': group['_id'], 'value': group[function.cache_name]}
+                for group in scan_states(self.collection, query, self.step,
+                    self.tags, [function])]
+
         pipeline = generator.dispatch_function(self.start, self.stop, self.step,
-            self.aggregation_function, self.tags)
-        return self.collection.aggregate(pipeline)['result']
+            self.aggregation_function, self.tags, rollup=self.rollup)
 
-class RangeWorker(object):
+        if self.rollup:
+            state = function.rollup_state
+        else:
+            state = function.state
+
+        return [{'_id': r['_id'], 'value': state(r)} for r in
+            self.collection.aggregate(pipeline)['result']]
 
-    functions = {
-        'sum': sum,
-        'min': min,
-        'max': max
-    }
+class RangeWorker(object):
 
     def __init__(self, range, aggregation_function=None,
             tags=None, collection=None):
@@ -205,24 +264,152 @@ class RangeWorker(object):
         return self.__str__()
 
     def compute(self):
-        generator = PipelineGenerator()
+        function = get_function(self.aggregation_function)
 
         results = []
 
         generator = PipelineGenerator()
         for sub_range in self.missing:
+            if function.scanned:
+                query = generator.dispatch_scan(sub_range.start,
+                    sub_range.stop, self.tags)
+                results.extend(group[function.cache_name] for group in
+                    scan_states(self.collection, query, None, self.tags,
+                        [function]))
+                continue
+
             pipeline = generator.dispatch_function(sub_range.start, sub_range.stop,
                 function=self.aggregation_function, tags=self.tags)
-            results.append(self.collection.aggregate(pipeline)['result'][0]['value'])
-
-        function = self.functions[self.aggregation_function]
+            # Subrange may have no points
+            for r in self.collection.aggregate(pipeline)['result']:
+                results.append(function.state(r))
 
         results.extend([x.value for x in self.partial])
 
+        if not results:
+            return []
+
         id_doc = {'date': self.start}
 
         if self.tags:
             id_doc['tags'] = self.tags
 
-        return [{'_id': id_doc, 'value': function(results)}]
+        return [{'_id': id_doc, 'value': function.merge(results)}]
+
+
+
+class BatchWorker(object):
+    """Compute several requests on the same metric and range at once.
+
+    Requests are (function, tags) pairs which must use the same tags names,
+    they can differ by function or tags values. Only one aggregation is made
+    (and a single scan for scanned functions), its groups are then split back
+    per request.
+    """
+
+    def __init__(self, start, stop, step, requests, collection=None,
+            rollup=False):
+        self.start = start
+        self.stop = stop
+        self.step = step
+        self.requests = requests
+        self.collection = collection
+        self.rollup = rollup
+
+    def __eq__(self, subrange):
+        return self.__dict__ == subrange.__dict__
+
+    def __str__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.__dict__)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def compute(self):
+        generator = PipelineGenerator()
+
+        functions = []
+        for function, _ in self.requests:
+            if get_function(function) not in functions:
+                functions.append(get_function(function))
+
+        # Rollups contain states of scanned functions
+        if self.rollup:
+            functions_groups = [functions]
+        else:
+            functions_groups = partition_functions(functions)
+
+        merged_tags = self._merge_tags()
+
+        groups = {}
+        for functions_group in functions_groups:
+            if functions_group[0].scanned and not self.rollup:
+                query = generator.dispatch_scan(self.start, self.stop,
+                    merged_tags)
+                batch_groups = scan_states(self.collection, query,
+                    self.step, merged_tags, functions_group)
+            else:
+                pipeline = generator.dispatch_functions(self.start, self.stop,
+                    self.step, [f.name for f in functions_group],
+                    merged_tags, rollup=self.rollup)
+                batch_groups = self.collection.aggregate(pipeline)['result']
+
+            for group in batch_groups:
+                groups.setdefault(result_key(group), {}).update(group)
+        groups = groups.values()
+
+        results = []
+        for function_name, tags in self.requests:
+            function = get_function(function_name)
+
+            result = []
+            for group in groups:
+                if not self._match_tags(group['_id'].get('tags', {}), tags):
+                    continue
+
+                if function.scanned and not self.rollup:
+                    result.append({'_id': group['_id'],
+                        'value': group[function.cache_name]})
+                    continue
+
+                if self.rollup:
+                    accumulators, state = (function.rollup_accumulators(),
+                        function.rollup_state)
+                else:
+                    accumulators, state = (function.accumulators(),
+                        function.state)
+
+                document = dict((field, group[generator.batch_field(function,
+                    field)]) for field in accumulators)
+                result.append({'_id': group['_id'], 'value': state(document)})
+
+            results.append(result)
+
+        return results
+
+    def _merge_tags(self):
+        # Match union of requests tags values
+        tags = {}
+
+        for _, request_tags in self.requests:
+            for tag, value in request_tags.items():
+                values = tags.setdefault(tag, [])
+                if value not in values:
+                    values.append(value)
+
+        for tag, values in tags.items():
+            if '*' in values:
+                tags[tag] = '*'
+            elif len(values) == 1:
+                tags[tag] = values[0]
+            else:
+                tags[tag] = {'$in': values}
+
+        return tags
+
+    def _match_tags(self, group_tags, tags):
+        for tag, value in tags.items():
+            if value != '*' and group_tags.get(tag) != value:
+                return False
 
+        return True
@@ -0,0 +1,295 @@
+from json import dumps
+from logging import getLogger
+from threading import Thread, Event
+from time import time
+
+from pipeline import PipelineGenerator
+from functions import ROLLUP_FUNCTIONS
+from ranges import result_key, partition_functions, scan_states
+
+
+RETENTION_COLLECTION = 'mongotsdb.retention'
+
+logger = getLogger('mongotsdb')
+
+
+def rollup_collection_name(metric_name, step):
+    return '%s.rollup.%d' % (metric_name, step)
+
+
+def rollup_id(date, tags):
+    """Id of the rollup document of a step and tags."""
+    return dumps([date, sorted(tags.items())], default=str)
+
+
+class RetentionPolicy(object):
+    """Retention tiers of a metric.
+
+    Tiers are dicts with a step (None for raw metrics), a duration in seconds
+    (None to keep data forever) and the watermark of the rollup, the date
+    before which all steps have been rolled up. First tier is raw metrics,
+    other ones are rollups sorted by step, each step dividing the next one.
+    """
+
+    def __init__(self, tiers):
+        self.tiers = tiers
+
+        if not tiers or tiers[0]['step'] is not None:
+            raise ValueError('First retention tier must be raw metrics')
+
+        steps = [tier['step'] for tier in tiers[1:]]
+        for step, next_step in zip([1] + steps, steps):
+            if next_step is None or next_step % step:
+                raise ValueError('Retention steps must divide the next ones')
+
+    def __eq__(self, policy):
+        return self.__dict__ == policy.__dict__
+
+    def __str__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.__dict__)
+
+    def __repr__(self):
+        return self.__str__()
+
+    @classmethod
+    def from_rules(cls, rules):
+        """Create a policy from a list of (step, duration) rules."""
+        return cls([{'step': step, 'duration': duration, 'watermark': None}
+            for step, duration in rules])
+
+    def route(self, start, step, now):
+        """Return the index of the finest tier still retaining start."""
+        candidates = [index for index, tier in enumerate(self.tiers)
+            if tier['step'] is None or step % tier['step'] == 0]
+
+        for index in candidates:
+            duration = self.tiers[index]['duration']
+            if duration is None or start >= now - duration:
+                return index
+
+        # No tier retains start, use the one retaining data the longer
+        return candidates[-1]
+
+    def segments(self, start, stop, step, now):
+        """Split a request range into (tier step, start, stop) segments.
+
+        Data after a tier watermark are not rolled up yet, they are read from
+        the finer tiers, up to raw metrics. Rollups documents contain whole
+        steps, so the edges of the range which are not aligned to a tier step
+        are read from the finer tiers too.
+        """
+        return self._segments(self.route(start, step, now), start, stop)
+
+    def _segments(self, index, start, stop):
+        if start > stop:
+            return []
+
+        tier = self.tiers[index]
+
+        if tier['step'] is None:
+            return [(None, start, stop)]
+
+        aligned_start = start + (-start % tier['step'])
+        aligned_stop = stop + 1 - ((stop + 1) % tier['step'])
+        if tier['watermark'] is not None:
+            aligned_stop = min(aligned_stop, tier['watermark'])
+
+        if tier['watermark'] is None or aligned_start >= aligned_stop:
+            return self._segments(index - 1, start, stop)
+
+        return (self._segments(index - 1, start, aligned_start - 1) +
+            [(tier['step'], aligned_start, aligned_stop - 1)] +
+            self._segments(index - 1, aligned_stop, stop))
+
+
+class Compactor(object):
+    """Roll up closed steps of each tier, then delete expired data.
+
+    Each rollup tier is computed from the previous tier, data of a tier are
+    deleted only once they have been rolled up into the next one. A step is
+    closed lag seconds after its end, points inserted later into a rolled up
+    step are not added to the rollups.
+
+    Steps are rolled up by chunks of chunk_steps steps and the tier watermark
+    is saved after each chunk. Rollups documents ids are computed from their
+    date and tags, so compacting a chunk again (after a crash, or by two
+    concurrent compactions) overwrites the same documents.
+    """
+
+    def __init__(self, db, metric_name, policy, lag=60, chunk_steps=100):
+        self.db = db
+        self.metric_name = metric_name
+        self.policy = policy
+        self.lag = lag
+        self.chunk_steps = chunk_steps
+
+    def compact(self, now):
+        generator = PipelineGenerator()
+        tiers = self.policy.tiers
+
+        for index, (source, tier) in enumerate(zip(tiers, tiers[1:]), 1):
+            step = tier['step']
+
+            # Only roll up closed steps
+            stop = (now - self.lag) - ((now - self.lag) % step)
+
+            # Rollups sources are complete up to their watermark only
+            if source['step'] is not None:
+                if source['watermark'] is None:
+                    continue
+                source_stop = source['watermark']
+                stop = min(stop, source_stop - (source_stop % step))
+
+            source_collection = self._collection(source)
+            source_collection.ensure_index('date')
+            self._collection(tier).ensure_index('date')
+
+            start = tier['watermark']
+
+            while start is None or start < stop:
+                # Skip steps without points
+                first_date = self._first_date(source_collection, start)
+
+                if first_date is None or first_date >= stop:
+                    self._save_watermark(index, stop)
+                    break
+
+                first_step = first_date - (first_date % step)
+                if start is None or first_step > start:
+                    start = first_step
+                chunk_stop = min(stop, start + self.chunk_steps * step)
+
+                self._rollup(generator, source, tier, start, chunk_stop - 1)
+                self._save_watermark(index, chunk_stop)
+
+                start = chunk_stop
+
+        for tier, next_tier in zip(tiers, tiers[1:] + [None]):
+            if tier['duration'] is None:
+                continue
+
+            expiration = now - tier['duration']
+
+            # Keep data which are not rolled up yet, and delete whole steps of
+            # the next tier only, so a step is never rolled up again from a
+            # part of its data
+            if next_tier is not None:
+                expiration = min(expiration, next_tier['watermark'] or 0)
+                expiration -= expiration % next_tier['step']
+
+            self._collection(tier).remove({'date': {'$lt': expiration}})
+
+    def _rollup(self, generator, source, tier, start, stop):
+        rollup = source['step'] is not None
+
+        source_collection = self._collection(source)
+
+        groups = {}
+        for functions in self._partition(source):
+            if functions[0].scanned and not rollup:
+                query = generator.dispatch_scan(start, stop, {})
+                rollup_groups = scan_states(source_collection, query,
+                    tier['step'], {}, functions, whole_tags=True)
+            else:
+                pipeline = generator.dispatch_rollup(start, stop,
+                    tier['step'], rollup=rollup, functions=functions)
+                rollup_groups = source_collection.aggregate(
+                    pipeline)['result']
+
+            for group in rollup_groups:
+                groups.setdefault(result_key(group), {}).update(group)
+
+        collection = self._collection(tier)
+        for group in groups.values():
+            collection.save(self._rollup_document(generator, group,
+                rollup=rollup))
+
+    def _first_date(self, collection, start):
+        query = {}
+        if start is not None:
+            query['date'] = {'$gte': start}
+
+        for document in collection.find(query, fields=['date']).sort(
+                'date', 1).limit(1):
+            return document['date']
+
+        return None
+
+    def _save_watermark(self, index, watermark):
+        self.policy.tiers[index]['watermark'] = watermark
+
+        # Never move a watermark saved by a concurrent compaction backward
+        field = 'tiers.%d.watermark' % index
+        self.db[RETENTION_COLLECTION].update({'_id': self.metric_name,
+            '$or': [{field: None}, {field: {'$lt': watermark}}]},
+            {'$set': {field: watermark}})
+
+    def _partition(self, source):
+        # Scanned functions are computed apart on raw metrics
+        if source['step'] is None:
+            return partition_functions(ROLLUP_FUNCTIONS)
+
+        return [ROLLUP_FUNCTIONS]
+
+    def _collection(self, tier):
+        if tier['step'] is None:
+            return self.db[self.metric_name]
+
+        return self.db[rollup_collection_name(self.metric_name, tier['step'])]
+
+    def _rollup_document(self, generator, group, rollup=False):
+        tags = group['_id'].get('tags') or {}
+        document = {'_id': rollup_id(group['_id']['date'], tags),
+            'date': group['_id']['date']}
+
+        if tags:
+            document['tags'] = tags
+
+        for function in ROLLUP_FUNCTIONS:
+            if function.scanned and not rollup:
+                document[function.cache_name] = function.dump(
+                    group[function.cache_name])
+                continue
+
+            if rollup:
+                accumulators = function.rollup_accumulators()
+            else:
+                accumulators = function.accumulators()
+
+            function_document = dict((field,
+                group[generator.batch_field(function, field)])
+                for field in accumulators)
+
+            if rollup:
+                state = function.rollup_state(function_document)
+            else:
+                state = function.state(function_document)
+
+            document[function.cache_name] = function.dump(state)
+
+        return document
+
+
+class CompactionThread(Thread):
+    """Background thread compacting every metric with a retention policy."""
+
+    def __init__(self, tsdb, interval=60, lag=60):
+        Thread.__init__(self)
+        self.daemon = True
+        self.tsdb = tsdb
+        self.interval = interval
+        self.lag = lag
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            # Keep compacting on next interval, like after a lost connection
+            try:
+                self.tsdb.compact(int(time()), lag=self.lag)
+            except Exception:
+                logger.exception('Compaction failed')
+
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
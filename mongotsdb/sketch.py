@@ -0,0 +1,111 @@
+from math import ceil, log
+
+
+class DDSketch(object):
+    """Mergeable quantile sketch with relative error guarantee.
+
+    Values are counted in logarithmic bins, so two sketches built with the
+    same relative accuracy can be merged by adding their bins counts. It lets
+    us cache a sketch per step and combine cached and fresh subranges without
+    reading raw points again.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = log(self.gamma)
+
+        self.bins = {}
+        self.negative_bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def __eq__(self, sketch):
+        return self.__dict__ == sketch.__dict__
+
+    def __str__(self):
+        return '%s(%s)' % (self.__class__.__name__, self.__dict__)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def add(self, value, count=1):
+        if value > 0:
+            index = self._index(value)
+            self.bins[index] = self.bins.get(index, 0) + count
+        elif value < 0:
+            index = self._index(-value)
+            self.negative_bins[index] = self.negative_bins.get(index, 0) + count
+        else:
+            self.zero_count += count
+
+        self.count += count
+
+    def merge(self, sketch):
+        assert sketch.relative_accuracy == self.relative_accuracy
+
+        for index, count in sketch.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+
+        for index, count in sketch.negative_bins.items():
+            self.negative_bins[index] = self.negative_bins.get(index, 0) + count
+
+        self.zero_count += sketch.zero_count
+        self.count += sketch.count
+
+    def quantile(self, quantile):
+        if self.count == 0:
+            return None
+
+        rank = quantile * (self.count - 1)
+        seen = 0
+
+        # Negative values, from the lowest to the highest
+        for index in sorted(self.negative_bins, reverse=True):
+            seen += self.negative_bins[index]
+            if seen > rank:
+                return -self._value(index)
+
+        seen += self.zero_count
+        if seen > rank:
+            return 0
+
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return self._value(index)
+
+        return self._value(max(self.bins))
+
+    # Serialization, mongo documents keys must be strings
+
+    def to_dict(self):
+        return {'relative_accuracy': self.relative_accuracy,
+            'bins': sorted(self.bins.items()),
+            'negative_bins': sorted(self.negative_bins.items()),
+            'zero_count': self.zero_count}
+
+    @classmethod
+    def from_dict(cls, document):
+        sketch = cls(document['relative_accuracy'])
+
+        for index, count in document['bins']:
+            sketch.bins[index] = count
+            sketch.count += count
+
+        for index, count in document['negative_bins']:
+            sketch.negative_bins[index] = count
+            sketch.count += count
+
+        sketch.zero_count = document['zero_count']
+        sketch.count += sketch.zero_count
+
+        return sketch
+
+    # Util function
+
+    def _index(self, value):
+        return int(ceil(log(value) / self.log_gamma))
+
+    def _value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
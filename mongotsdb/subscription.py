@@ -0,0 +1,159 @@
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+
+from ranges import result_key
+from functions import get_function
+
+
+class Subscription(object):
+    """Incremental request for dashboards polling a sliding window.
+
+    The first poll computes the whole window, next ones only recompute the
+    last step of the previous poll (which was still open), the new steps and
+    the steps which received late points. Late points are found with their
+    ObjectId, which contains their insertion time, so the cost of a poll does
+    not depend on the window width. ObjectIds are only ordered by second and
+    clients clocks may differ, so points inserted since margin seconds before
+    the previous poll are checked.
+
+    Each poll returns a delta, a dict with updated results and removed ids.
+    """
+
+    def __init__(self, tsdb, request, margin=5):
+        self.tsdb = tsdb
+        self.margin = margin
+        self.step = request['step']
+        self.width = request['stop'] - request['start']
+        self.aggregation_function, self.metric_name = tsdb._parse_request(
+            request['request'])
+        self.tags = request.get('tags', {})
+
+        self.start = None
+        self.stop = None
+        self.last_poll = None
+        self.results = {}
+
+    @property
+    def result(self):
+        return [self.results[key] for key in sorted(self.results)]
+
+    def poll(self, stop):
+        start = stop - self.width
+
+        # Get poll time before computing, points inserted meanwhile will be
+        # seen as late by the next poll
+        poll_time = datetime.utcnow()
+
+        # Window moved backward or beyond previous one, compute it all. Cache
+        # is not used, it may contain steps which were still open.
+        if self.stop is None or stop < self.stop or start > self.stop:
+            delta = self._update([(start, stop)], self._compute(start, stop),
+                start)
+        else:
+            function = get_function(self.aggregation_function)
+            open_step = self.stop - (self.stop % self.step)
+
+            steps = set(self._late_steps(start, open_step))
+
+            # Late points change the previous step of the next steps too
+            if function.previous_step:
+                steps.update([step + self.step for step in steps])
+
+            # First step has lost some points, or its previous step
+            if start != self.start and (start % self.step or
+                    function.previous_step):
+                steps.add(start - (start % self.step))
+
+            spans = self._spans(sorted(steps), start, open_step - 1)
+            spans.append((max(open_step, start), stop))
+
+            results = []
+            for span_start, span_stop in spans:
+                results.extend(self._compute(span_start, span_stop, start))
+
+            delta = self._update(spans, results, start)
+
+        self.start = start
+        self.stop = stop
+        self.last_poll = poll_time
+
+        return delta
+
+    def _compute(self, start, stop, window_start=None):
+        function = get_function(self.aggregation_function)
+        span_start = start
+
+        # Compute previous step too, like a request on the whole window
+        if function.previous_step and window_start is not None:
+            start = max(window_start, start - self.step)
+
+        segments = self.tsdb._segments(self.metric_name, start, stop,
+            self.step)
+        results = self.tsdb._request_segments(segments, self.step,
+            self.aggregation_function, self.metric_name, self.tags)
+
+        return [r for r in self.tsdb._finalize(results, function)
+            if r['_id']['date'] >= span_start - (span_start % self.step)]
+
+    def _update(self, spans, results, start):
+        removed = []
+        start_step = lambda date: date - (date % self.step)
+
+        # Last span ends at the window stop
+        stop = spans[-1][1]
+
+        # Results out of window, before or after it if it moved backward, or
+        # of recomputed steps without points
+        new_keys = set(result_key(r) for r in results)
+        for key in self.results.keys():
+            date = key[0]
+            recomputed = any(start_step(span_start) <= date <= span_stop
+                for span_start, span_stop in spans)
+
+            if not start_step(start) <= date <= stop or (recomputed and
+                    key not in new_keys):
+                removed.append(self.results.pop(key)['_id'])
+
+        for r in results:
+            self.results[result_key(r)] = r
+
+        return {'updated': results, 'removed': removed}
+
+    def _late_steps(self, start, stop):
+        """Return steps between start and stop which received new points."""
+        if start >= stop:
+            return []
+
+        query = {'date': {'$gte': start, '$lt': stop}}
+
+        if self.last_poll is not None:
+            query['_id'] = {'$gte': ObjectId.from_datetime(self.last_poll -
+                timedelta(seconds=self.margin))}
+
+        for tag in self.tags:
+            if self.tags[tag] != '*':
+                query['tags.%s' % tag] = self.tags[tag]
+
+        # Points seen by the previous poll may be found again, steps are
+        # deduplicated
+        dates = self.tsdb.db[self.metric_name].find(query).distinct('date')
+        return set(date - (date % self.step) for date in dates)
+
+    def _spans(self, steps, start, stop):
+        """Merge contiguous steps into (start, stop) spans within bounds."""
+        spans = []
+
+        for step_start in steps:
+            span_start = max(step_start, start)
+            span_stop = min(step_start + self.step - 1, stop)
+
+            if span_start > span_stop:
+                continue
+
+            if spans and spans[-1][1] + 1 == span_start:
+                spans[-1] = (spans[-1][0], span_stop)
+            else:
+                spans.append((span_start, span_stop))
+
+        return spans
@@ -0,0 +1,107 @@
+import unittest
+
+from mongotsdb.expression import (parse, Number, Metric, Call,
+    BinaryOperation, Negation, ExpressionPlanner)
+
+
+class ParserTestCase(unittest.TestCase):
+
+    def test_aggregation(self):
+        node = parse('sum(sample)')
+
+        self.assertEqual(node, Call('sum', [Metric('sample')]))
+        self.assertTrue(node.is_aggregation())
+
+    def test_operators_precedence(self):
+        node = parse('sum(a) + sum(b) * 2')
+
+        expected = BinaryOperation('+', Call('sum', [Metric('a')]),
+            BinaryOperation('*', Call('sum', [Metric('b')]), Number(2)))
+        self.assertEqual(node, expected)
+
+    def test_parenthesis_and_negation(self):
+        node = parse('-(sum(a) - 1.5) / abs(max(b))')
+
+        expected = BinaryOperation('/',
+            Negation(BinaryOperation('-', Call('sum', [Metric('a')]),
+                Number(1.5))),
+            Call('abs', [Call('max', [Metric('b')])]))
+        self.assertEqual(node, expected)
+        self.assertFalse(node.is_aggregation())
+
+    def test_metric_names(self):
+        for name in ('my-metric', 'api/requests', '2xx'):
+            node = parse('sum(%s)' % name)
+
+            self.assertEqual(node, Call('sum', [Metric(name)]))
+            self.assertEqual(parse(str(node)), node)
+
+    def test_quoted_metric_names(self):
+        node = parse('sum(`my-metric`) / sum(`api/requests`)')
+
+        expected = BinaryOperation('/', Call('sum', [Metric('my-metric')]),
+            Call('sum', [Metric('api/requests')]))
+        self.assertEqual(node, expected)
+        self.assertEqual(parse(str(node)), node)
+
+    def test_invalid(self):
+        for request in ('sum(a', 'sum(a))', 'sum(a) +', 'sum(a) % 2'):
+            self.assertRaises(ValueError, parse, request)
+
+
+class FakeTSDB(object):
+
+    def __init__(self, results):
+        self.results = results
+        self.requests = []
+
+    def request_many(self, requests):
+        self.requests.extend(requests)
+        return [self.results[request['request']] for request in requests]
+
+
+class ExpressionPlannerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tsdb = FakeTSDB({
+            'sum(errors)': [{'_id': {'date': 0}, 'value': 5},
+                {'_id': {'date': 10}, 'value': 0}],
+            'sum(requests)': [{'_id': {'date': 0}, 'value': 50},
+                {'_id': {'date': 10}, 'value': 0}],
+            'max(latency)': [
+                {'_id': {'date': 0, 'tags': {'host': 1}}, 'value': 3},
+                {'_id': {'date': 0, 'tags': {'host': 2}}, 'value': 7}]})
+        self.planner = ExpressionPlanner(self.tsdb, 0, 19, 10)
+
+    def test_ratio(self):
+        result = self.planner.evaluate(parse('sum(errors) / sum(requests) * 100'))
+
+        # Division by zero has no value
+        expected = [{'_id': {'date': 0}, 'value': 10.0},
+            {'_id': {'date': 10}, 'value': None}]
+        self.assertEqual(result, expected)
+
+    def test_scalar_without_value(self):
+        expected = [{'_id': {'date': 0}, 'value': None},
+            {'_id': {'date': 10}, 'value': None}]
+
+        for text in ('sum(errors) * (1 / 0)', '-(1 / 0) + sum(errors)'):
+            self.assertEqual(self.planner.evaluate(parse(text)), expected)
+
+    def test_common_subexpressions(self):
+        self.planner.evaluate(parse('sum(errors) / sum(errors) + sum(errors)'))
+
+        self.assertEqual([r['request'] for r in self.tsdb.requests],
+            ['sum(errors)'])
+
+    def test_broadcast_and_reduce(self):
+        result = self.planner.evaluate(
+            parse('max(latency) - avg(max(latency))'))
+
+        expected = [{'_id': {'date': 0, 'tags': {'host': 1}}, 'value': -2.0},
+            {'_id': {'date': 0, 'tags': {'host': 2}}, 'value': 2.0}]
+        self.assertEqual(result, expected)
+
+    def test_metric_must_be_aggregated(self):
+        self.assertRaises(ValueError, self.planner.evaluate,
+            parse('sum(errors) / requests'))
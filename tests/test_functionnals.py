@@ -4,7 +4,8 @@ from pymongo import Connection
 
 from mongotsdb import TSDB
 
-from test_utils import (TemplateTestCase, template, Call, avg)
+from test_utils import (TemplateTestCase, template, Call, avg, stddev,
+    first, last)
 
 
 class FunctionnalTestCase(unittest.TestCase):
@@ -127,6 +128,10 @@ class RequestTestCase(FunctionnalTestCase):
         'avg': Call('avg', avg),
         'min': Call('min', min),
         'max': Call('max', max),
+        'count': Call('count', len),
+        'stddev': Call('stddev', stddev),
+        'first': Call('first', first),
+        'last': Call('last', last),
     })
     def _test_request_with_operator(self, operator, operator_function):
         # Define metrics
@@ -147,6 +152,270 @@ class RequestTestCase(FunctionnalTestCase):
         # Check return
         self.assertEqual(expected, result[0]['value'])
 
+    def test_rate_request(self):
+        # Define metrics, a counter increasing by 5 each 2 seconds
+        for i in range(10):
+            self.tsdb.insert({'date': i * 2, 'value': i * 5,
+                'name': self.metric_name})
+
+        # Make request
+        request = {'request': 'rate(%s)' % self.metric_name, 'start': 0,
+            'stop': 19, 'step': 10}
+        result = self.tsdb.request(request=request)
+
+        # Check return
+        expected = [{'_id': {'date': 0}, 'value': 2.5},
+            {'_id': {'date': 10}, 'value': 2.5}]
+        self.assertItemsEqual(result, expected)
+
+    def test_rate_request_single_point_by_step(self):
+        # Define metrics, a counter increasing by 30 each 10 seconds
+        for i in range(3):
+            self.tsdb.insert({'date': i * 10, 'value': i * 30,
+                'name': self.metric_name})
+
+        # Make request
+        request = {'request': 'rate(%s)' % self.metric_name, 'start': 0,
+            'stop': 29, 'step': 10}
+        result = self.tsdb.request(request=request)
+
+        # Check return, first step has no previous point
+        expected = [{'_id': {'date': 0}, 'value': None},
+            {'_id': {'date': 10}, 'value': 3.0},
+            {'_id': {'date': 20}, 'value': 3.0}]
+        self.assertItemsEqual(result, expected)
+
+    def test_percentile_request(self):
+        # Define metrics
+        for i in range(1, 101):
+            self.tsdb.insert({'date': i, 'value': i, 'name': self.metric_name})
+
+        # Make request
+        request = {'request': 'p95(%s)' % self.metric_name, 'start': 0,
+            'stop': 199, 'step': 200}
+        result = self.tsdb.request(request=request)
+
+        # Check return, percentiles are approximated at 1%
+        self.assertTrue(abs(result[0]['value'] - 95) <= 95 * 0.01)
+
+class ExpressionRequestTestCase(FunctionnalTestCase):
+
+    def test_expression_request(self):
+        # Define metrics
+        for i in range(20):
+            self.tsdb.insert({'date': i, 'value': i, 'name': self.metric_name})
+
+        # Make request
+        request = {'request': 'sum(%s) / count(%s) * 2' % (self.metric_name,
+            self.metric_name), 'start': 0, 'stop': 19, 'step': 10}
+        result = self.tsdb.request(request=request)
+
+        # Check return
+        expected = [{'_id': {'date': 0}, 'value': 9.0},
+            {'_id': {'date': 10}, 'value': 29.0}]
+        self.assertEqual(result, expected)
+
+
+class RetentionTestCase(FunctionnalTestCase):
+
+    def tearDown(self):
+        super(RetentionTestCase, self).tearDown()
+
+        db = Connection()[self.database_name]
+        db['mongotsdb.retention'].remove()
+        for step in (10, 100):
+            db['%s.rollup.%d' % (self.metric_name, step)].remove()
+
+    def test_compaction(self):
+        # Define metrics
+        for i in range(300):
+            self.tsdb.insert({'date': i, 'value': i, 'name': self.metric_name})
+
+        self.tsdb.set_retention(self.metric_name, [(None, 100), (10, 200),
+            (100, None)])
+
+        # Compact
+        self.tsdb.compact(now=300, lag=0)
+
+        db = Connection()[self.database_name]
+
+        # Raw metrics older than 100 seconds are rolled up and deleted
+        self.assertEqual(db[self.metric_name].find().count(), 100)
+        self.assertEqual(db['%s.rollup.10' % self.metric_name].find().count(), 20)
+        self.assertEqual(db['%s.rollup.100' % self.metric_name].find().count(), 3)
+
+        # Request is routed to rollups
+        for function, expected in (('sum', [4950, 14950, 24950]),
+                ('count', [100, 100, 100]), ('min', [0, 100, 200]),
+                ('first', [0, 100, 200])):
+            request = {'request': '%s(%s)' % (function, self.metric_name),
+                'start': 0, 'stop': 299, 'step': 100}
+            result = self.tsdb.request(request=request)
+
+            self.assertItemsEqual(result, [{'_id': {'date': date},
+                'value': value} for date, value in zip((0, 100, 200), expected)])
+
+    def test_compaction_tags(self):
+        # Define metrics, two hosts with different values
+        for i in range(300):
+            self.tsdb.insert({'date': i, 'value': 1000 * (i % 2) + i,
+                'name': self.metric_name, 'tags': {'host': i % 2}})
+
+        self.tsdb.set_retention(self.metric_name, [(None, 100), (10, 200),
+            (100, None)])
+        self.tsdb.compact(now=300, lag=0)
+
+        # Ordered functions use the points dates of every tags rollups
+        for function, expected in (('first', [0, 100, 200]),
+                ('last', [1099, 1199, 1299]),
+                ('rate', [1099 / 99.0, 1.0, 1.0])):
+            request = {'request': '%s(%s)' % (function, self.metric_name),
+                'start': 0, 'stop': 299, 'step': 100}
+            result = self.tsdb.request(request=request)
+
+            self.assertItemsEqual(result, [{'_id': {'date': date},
+                'value': value} for date, value in zip((0, 100, 200), expected)])
+
+    def test_compaction_expression(self):
+        # Define metrics
+        for i in range(300):
+            self.tsdb.insert({'date': i, 'value': i, 'name': self.metric_name})
+
+        self.tsdb.set_retention(self.metric_name, [(None, 100), (10, None)])
+        self.tsdb.compact(now=300, lag=0)
+
+        # Expressions and batched requests are routed to rollups too
+        request = {'request': 'sum(%s) / count(%s)' % (self.metric_name,
+            self.metric_name), 'start': 0, 'stop': 299, 'step': 100}
+        result = self.tsdb.request(request=request)
+
+        self.assertEqual(result, [{'_id': {'date': 0}, 'value': 49.5},
+            {'_id': {'date': 100}, 'value': 149.5},
+            {'_id': {'date': 200}, 'value': 249.5}])
+
+    def test_compaction_again(self):
+        # Define metrics
+        for i in range(300):
+            self.tsdb.insert({'date': i, 'value': i, 'name': self.metric_name,
+                'tags': {'host': i % 2}})
+
+        self.tsdb.set_retention(self.metric_name, [(None, 100), (10, None)])
+        self.tsdb.compact(now=300, lag=0)
+
+        # Compact again as if the watermark was not saved
+        db = Connection()[self.database_name]
+        db['mongotsdb.retention'].update({'_id': self.metric_name},
+            {'$set': {'tiers.1.watermark': None}})
+        self.tsdb.compact(now=300, lag=0)
+
+        # Rollups are not duplicated
+        rollups = db['%s.rollup.10' % self.metric_name]
+        self.assertEqual(rollups.find().count(), 60)
+
+        request = {'request': 'sum(%s)' % self.metric_name, 'start': 0,
+            'stop': 299, 'step': 100}
+        result = self.tsdb.request(request=request)
+        self.assertItemsEqual(result, [{'_id': {'date': 0}, 'value': 4950},
+            {'_id': {'date': 100}, 'value': 14950},
+            {'_id': {'date': 200}, 'value': 24950}])
+
+    def test_compaction_lag(self):
+        # Define metrics
+        for i in range(300):
+            self.tsdb.insert({'date': i, 'value': i, 'name': self.metric_name})
+
+        self.tsdb.set_retention(self.metric_name, [(None, 100), (10, None)])
+        self.tsdb.compact(now=300, lag=60)
+
+        # Steps ended less than 60 seconds ago are not rolled up
+        self.assertEqual(self.tsdb.get_retention(
+            self.metric_name).tiers[1]['watermark'], 240)
+
+
+class SubscriptionTestCase(FunctionnalTestCase):
+
+    def test_live_tail(self):
+        # Define metrics
+        for i in range(30):
+            self.tsdb.insert({'date': i, 'value': 1, 'name': self.metric_name})
+
+        subscription = self.tsdb.subscribe({'request': 'sum(%s)' %
+            self.metric_name, 'start': 0, 'stop': 29, 'step': 10})
+
+        delta = subscription.poll(29)
+        self.assertEqual(len(delta['updated']), 3)
+
+        # New points, and a late one in the first step
+        for i in range(30, 45):
+            self.tsdb.insert({'date': i, 'value': 1, 'name': self.metric_name})
+        self.tsdb.insert({'date': 12, 'value': 1, 'name': self.metric_name})
+
+        delta = subscription.poll(39)
+
+        self.assertItemsEqual(delta['updated'], [
+            {'_id': {'date': 10}, 'value': 11},
+            {'_id': {'date': 20}, 'value': 10},
+            {'_id': {'date': 30}, 'value': 10}])
+        self.assertEqual(delta['removed'], [{'date': 0}])
+        self.assertEqual(subscription.result, [
+            {'_id': {'date': 10}, 'value': 11},
+            {'_id': {'date': 20}, 'value': 10},
+            {'_id': {'date': 30}, 'value': 10}])
+
+    def test_live_tail_rate(self):
+        # Define metrics, a counter
+        for i in range(0, 30, 2):
+            self.tsdb.insert({'date': i, 'value': i * 3,
+                'name': self.metric_name})
+
+        request = {'request': 'rate(%s)' % self.metric_name, 'start': 0,
+            'stop': 29, 'step': 10}
+        subscription = self.tsdb.subscribe(request)
+        subscription.poll(29)
+
+        # New points, and a late one changing the previous step of step 20
+        for i in range(30, 45, 2):
+            self.tsdb.insert({'date': i, 'value': i * 3,
+                'name': self.metric_name})
+        self.tsdb.insert({'date': 19, 'value': 60, 'name': self.metric_name})
+
+        subscription.poll(39)
+
+        # Incremental result is the same as a request on the whole window
+        request = dict(request, start=10, stop=39)
+        self.assertEqual(subscription.result, sorted(self.tsdb.request(request),
+            key=lambda r: r['_id']['date']))
+
+
+class RequestManyTestCase(FunctionnalTestCase):
+
+    def test_request_many(self):
+        # Define metrics
+        for i in range(20):
+            self.tsdb.insert({'date': i, 'value': i, 'name': self.metric_name,
+                'tags': {'host': i % 2}})
+
+        # Make requests
+        base = {'start': 0, 'stop': 19, 'step': 10}
+        requests = [
+            dict(base, request='sum(%s)' % self.metric_name,
+                tags={'host': 0}),
+            dict(base, request='max(%s)' % self.metric_name,
+                tags={'host': 1}),
+            dict(base, request='count(%s)' % self.metric_name,
+                tags={'host': '*'}),
+            dict(base, request='min(%s)' % self.metric_name)]
+        results = self.tsdb.request_many(requests)
+
+        # Check return, each result is the same as a single request
+        for request, result in zip(requests, results):
+            self.assertItemsEqual(result, self.tsdb.request(request))
+
+        expected = [{'_id': {'date': 0, 'tags': {'host': 0}}, 'value': 20},
+            {'_id': {'date': 10, 'tags': {'host': 0}}, 'value': 70}]
+        self.assertItemsEqual(results[0], expected)
+
+
 class RequestCacheTestCase(FunctionnalTestCase):
 
     def test_simple_sum_request(self):
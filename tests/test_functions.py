@@ -0,0 +1,136 @@
+import unittest
+
+from mongotsdb.functions import get_function
+from mongotsdb.sketch import DDSketch
+
+
+class FunctionsTestCase(unittest.TestCase):
+
+    def test_unknown_function(self):
+        self.assertEqual(get_function('unknown'), None)
+
+    def test_merge_sum(self):
+        function = get_function('sum')
+        self.assertEqual(function.finalize(function.merge([1, 2, 3])), 6)
+
+    def test_merge_avg(self):
+        function = get_function('avg')
+        states = [{'sum': 10, 'count': 2}, {'sum': 5, 'count': 3}]
+
+        self.assertEqual(function.finalize(function.merge(states)), 3.0)
+
+    def test_merge_stddev(self):
+        function = get_function('stddev')
+        values = [2, 4, 4, 4, 5, 5, 7, 9]
+
+        states = [None, None]
+        for index, value in enumerate(values):
+            states[index > 2] = function.add(states[index > 2], value)
+
+        self.assertAlmostEqual(function.finalize(function.merge(states)), 2.0)
+
+    def test_stddev_large_offset(self):
+        function = get_function('stddev')
+
+        states = [None, None]
+        for value in range(1, 6):
+            states[value % 2] = function.add(states[value % 2], 1e9 + value)
+
+        self.assertAlmostEqual(function.finalize(function.merge(states)),
+            2 ** 0.5)
+
+    def test_merge_first_last(self):
+        states = [{'date': 5, 'value': 1}, {'date': 2, 'value': 3}]
+
+        first = get_function('first')
+        self.assertEqual(first.finalize(first.merge(states)), 3)
+
+        last = get_function('last')
+        self.assertEqual(last.finalize(last.merge(states)), 1)
+
+    def test_merge_rate(self):
+        function = get_function('rate')
+        states = [
+            {'first': {'date': 10, 'value': 100}, 'last': {'date': 19, 'value': 150}},
+            {'first': {'date': 0, 'value': 0}, 'last': {'date': 9, 'value': 90}}]
+
+        self.assertEqual(function.finalize(function.merge(states)), 150 / 19.0)
+
+    def test_rollup_state_ordered(self):
+        # Rollups of several tags, their order does not follow points dates
+        first, last = get_function('first'), get_function('last')
+        states = [{'date': 5, 'value': 1}, {'date': 2, 'value': 3},
+            {'date': 7, 'value': 4}, {'date': 6, 'value': 2}]
+
+        self.assertEqual(first.finalize(first.rollup_state(
+            {'states': states})), 3)
+        self.assertEqual(last.finalize(last.rollup_state(
+            {'states': states})), 4)
+
+        rate = get_function('rate')
+        states = [
+            {'first': {'date': 3, 'value': 30}, 'last': {'date': 8, 'value': 80}},
+            {'first': {'date': 0, 'value': 0}, 'last': {'date': 9, 'value': 90}},
+            {'first': {'date': 1, 'value': 10}, 'last': {'date': 4, 'value': 40}}]
+
+        self.assertEqual(rate.finalize(rate.rollup_state({'states': states})),
+            10.0)
+
+    def test_rate_previous_step(self):
+        function = get_function('rate')
+
+        # A single point by step
+        results = [{'_id': {'date': date}, 'value': {
+            'first': {'date': date, 'value': date * 3},
+            'last': {'date': date, 'value': date * 3}}}
+            for date in (20, 0, 10)]
+
+        expected = [{'_id': {'date': 0}, 'value': None},
+            {'_id': {'date': 10}, 'value': 3.0},
+            {'_id': {'date': 20}, 'value': 3.0}]
+        self.assertEqual(function.finalize_results(results), expected)
+
+    def test_percentile_add(self):
+        function = get_function('p95')
+
+        state = None
+        for value in [1] * 94 + [100] * 6:
+            state = function.add(state, value)
+
+        self.assertTrue(abs(function.finalize(state) - 100) <= 100 * 0.01)
+
+    def test_merge_percentile(self):
+        function = get_function('p50')
+
+        states = [None, None]
+        for value in range(1, 101):
+            states[value > 50] = function.add(states[value > 50], value)
+        states[1] = function.load(function.dump(states[1]))
+
+        result = function.finalize(function.merge(states))
+        self.assertTrue(abs(result - 50) <= 50 * 0.01)
+
+
+class DDSketchTestCase(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(DDSketch().quantile(0.5), None)
+
+    def test_relative_accuracy(self):
+        sketch = DDSketch(0.01)
+        values = range(-100, 1001)
+
+        for value in values:
+            sketch.add(value)
+
+        for quantile in (0, 0.25, 0.5, 0.95, 0.99, 1):
+            expected = values[int(quantile * (len(values) - 1))]
+            self.assertTrue(abs(sketch.quantile(quantile) - expected) <=
+                abs(expected) * 0.01)
+
+    def test_serialization(self):
+        sketch = DDSketch()
+        for value in (-3, 0, 1, 42):
+            sketch.add(value)
+
+        self.assertEqual(DDSketch.from_dict(sketch.to_dict()), sketch)
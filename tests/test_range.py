@@ -1,6 +1,8 @@
 import unittest
 
-from mongotsdb import Range, SubRange, RangeSet, MultiRangeWorker, RangeWorker
+from mongotsdb import (Range, SubRange, RangeSet, MultiRangeWorker, RangeWorker,
+    BatchWorker, scan_states)
+from mongotsdb.functions import get_function
 
 class RangeTestCase(unittest.TestCase):
 
@@ -125,3 +127,47 @@ class RangeSetTestCase(unittest.TestCase):
         self.assertEqual(range_set.ranges, [Range(5, 9), Range(10, 19),
             Range(20, 25)])
 
+
+class BatchWorkerTestCase(unittest.TestCase):
+
+    def test_merge_tags(self):
+        worker = BatchWorker(0, 49, 10, [('sum', {'host': 1, 'dc': 'a'}),
+            ('max', {'host': 2, 'dc': 'a'}), ('min', {'host': 1, 'dc': '*'})])
+
+        self.assertEqual(worker._merge_tags(), {'host': {'$in': [1, 2]},
+            'dc': '*'})
+
+    def test_match_tags(self):
+        worker = BatchWorker(0, 49, 10, [])
+
+        self.assertTrue(worker._match_tags({'host': 1, 'dc': 'a'},
+            {'host': 1, 'dc': '*'}))
+        self.assertFalse(worker._match_tags({'host': 2, 'dc': 'a'},
+            {'host': 1, 'dc': '*'}))
+
+
+class FakeCollection(object):
+
+    def __init__(self, points):
+        self.points = points
+
+    def find(self, query, fields=None):
+        return self.points
+
+
+class ScanStatesTestCase(unittest.TestCase):
+
+    def test_scan_states(self):
+        collection = FakeCollection([
+            {'date': 1, 'value': 10, 'tags': {'host': 1, 'dc': 'a'}},
+            {'date': 2, 'value': 20, 'tags': {'host': 1, 'dc': 'b'}},
+            {'date': 12, 'value': 30, 'tags': {'host': 2, 'dc': 'a'}}])
+        p50, p99 = get_function('p50'), get_function('p99')
+
+        groups = scan_states(collection, {}, 10, {'host': '*'}, [p50, p99])
+
+        # Percentiles share a single sketch
+        self.assertEqual(sorted((group['_id']['date'],
+            group['sketch'].count) for group in groups), [(0, 2), (10, 1)])
+        self.assertEqual(sorted(group['_id']['tags']['host']
+            for group in groups), [1, 2])
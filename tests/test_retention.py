@@ -0,0 +1,63 @@
+import unittest
+
+from mongotsdb.retention import RetentionPolicy, rollup_id
+
+
+class RetentionPolicyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = RetentionPolicy.from_rules([(None, 100), (10, 1000),
+            (100, None)])
+
+    def test_invalid_rules(self):
+        self.assertRaises(ValueError, RetentionPolicy.from_rules,
+            [(10, 100)])
+        self.assertRaises(ValueError, RetentionPolicy.from_rules,
+            [(None, 100), (10, 100), (25, None)])
+
+    def test_route(self):
+        now = 2000
+
+        self.assertEqual(self.policy.route(1950, 10, now), 0)
+        self.assertEqual(self.policy.route(1500, 10, now), 1)
+        self.assertEqual(self.policy.route(500, 100, now), 2)
+
+        # Step not multiple of rollups steps
+        self.assertEqual(self.policy.route(500, 5, now), 0)
+
+    def test_segments_without_rollups(self):
+        self.assertEqual(self.policy.segments(500, 1999, 100, 2000),
+            [(None, 500, 1999)])
+
+    def test_segments(self):
+        self.policy.tiers[1]['watermark'] = 1900
+        self.policy.tiers[2]['watermark'] = 1800
+
+        self.assertEqual(self.policy.segments(500, 1999, 100, 2000),
+            [(100, 500, 1799), (10, 1800, 1899), (None, 1900, 1999)])
+
+        # Raw metrics are still retained, no need for rollups
+        self.assertEqual(self.policy.segments(1950, 1999, 10, 2000),
+            [(None, 1950, 1999)])
+
+
+    def test_unaligned_segments(self):
+        self.policy.tiers[1]['watermark'] = 1900
+
+        # Edges are read from raw metrics, rollups contain whole steps
+        self.assertEqual(self.policy.segments(155, 1234, 10, 2000),
+            [(None, 155, 159), (10, 160, 1229), (None, 1230, 1234)])
+
+        # Range inside a single step
+        self.assertEqual(self.policy.segments(1501, 1508, 10, 2000),
+            [(None, 1501, 1508)])
+
+
+class RollupIdTestCase(unittest.TestCase):
+
+    def test_tags_order(self):
+        tags = {'host': 'host1', 'category': '3', 'dc': 'eu'}
+
+        self.assertEqual(rollup_id(10, tags), rollup_id(10, dict(
+            reversed(sorted(tags.items())))))
+        self.assertNotEqual(rollup_id(10, tags), rollup_id(20, tags))
@@ -0,0 +1,86 @@
+import unittest
+
+from mongotsdb.subscription import Subscription
+
+
+class FakeTSDB(object):
+
+    def _parse_request(self, request_call):
+        return request_call.replace('(', ' ').replace(')', '').split()
+
+
+class RecordingSubscription(Subscription):
+
+    late_steps = set()
+
+    def __init__(self, *args, **kwargs):
+        Subscription.__init__(self, *args, **kwargs)
+        self.spans = []
+
+    def _late_steps(self, start, stop):
+        return self.late_steps
+
+    def _compute(self, start, stop, window_start=None):
+        self.spans.append((start, stop))
+        return []
+
+
+class SubscriptionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.subscription = Subscription(FakeTSDB(), {'request': 'sum(sample)',
+            'start': 0, 'stop': 99, 'step': 10})
+
+    def test_spans(self):
+        spans = self.subscription._spans([0, 10, 30, 60], 5, 64)
+
+        self.assertEqual(spans, [(5, 19), (30, 39), (60, 64)])
+
+    def test_update(self):
+        self.subscription._update([(0, 29)], [
+            {'_id': {'date': 0}, 'value': 1},
+            {'_id': {'date': 10}, 'value': 2},
+            {'_id': {'date': 20}, 'value': 3}], 0)
+
+        # Window slides to 15, step 20 has no more points
+        delta = self.subscription._update([(15, 19), (20, 39)],
+            [{'_id': {'date': 10}, 'value': 1},
+             {'_id': {'date': 30}, 'value': 4}], 15)
+
+        self.assertEqual(delta['removed'], [{'date': 0}, {'date': 20}])
+        self.assertEqual(self.subscription.result, [
+            {'_id': {'date': 10}, 'value': 1},
+            {'_id': {'date': 30}, 'value': 4}])
+
+    def test_update_backward(self):
+        self.subscription._update([(100, 199)], [
+            {'_id': {'date': date}, 'value': 1}
+            for date in range(100, 200, 10)], 100)
+
+        # Window moves backward to [50, 149], steps after it are removed
+        delta = self.subscription._update([(50, 149)], [
+            {'_id': {'date': date}, 'value': 2}
+            for date in range(50, 150, 10)], 50)
+
+        self.assertEqual(sorted(delta['removed']),
+            [{'date': date} for date in range(150, 200, 10)])
+        self.assertEqual(self.subscription.result, [
+            {'_id': {'date': date}, 'value': 2}
+            for date in range(50, 150, 10)])
+
+    def test_poll_previous_step(self):
+        for function, expected in (('sum', [(30, 39), (90, 119)]),
+                ('rate', [(20, 49), (90, 119)])):
+            subscription = RecordingSubscription(FakeTSDB(),
+                {'request': '%s(sample)' % function, 'start': 0, 'stop': 99,
+                'step': 10})
+            subscription.poll(99)
+
+            # Late point in step 30, window slides by two steps
+            subscription.late_steps = set([30])
+            subscription.spans = []
+            subscription.poll(119)
+
+            # Next step of late ones and new first step use another previous
+            # step for rate
+            self.assertEqual(subscription.spans, expected)
@@ -3,6 +3,16 @@
 def avg(values):
     return sum(values)/len(values)
 
+def stddev(values):
+    mean = float(sum(values))/len(values)
+    return (sum((v - mean) ** 2 for v in values)/len(values)) ** 0.5
+
+def first(values):
+    return values[0]
+
+def last(values):
+    return values[-1]
+
 # Test templates
 from functools import (partial, wraps)
 